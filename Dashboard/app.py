@@ -1,15 +1,41 @@
 import os
 import dash
-from dash import dcc, html, Input, Output, State
+from dash import dcc, html, Input, Output, State, CeleryManager, DiskcacheManager
 import plotly.graph_objects as go
 import pandas as pd
-from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Image as PlatypusImage
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
+from reportlab.lib import colors
+from reportlab.graphics.shapes import Drawing, Group, String
+from reportlab.graphics.charts.barcharts import VerticalBarChart
+import base64
+import numpy as np
 import io
 import plotly.io as pio
 import sys
+import re
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from flask import Response, request, stream_with_context
+
+# Dash serializes callback payloads through plotly.io.json, which is much
+# faster with orjson. Select it explicitly and warn when it is missing.
+try:
+    import orjson  # noqa: F401
+    pio.json.config.default_engine = "orjson"
+except ImportError:
+    print("WARNING: orjson is not installed. Callback payloads will use the slower standard JSON encoder.", file=sys.stderr)
+
+# ReportLab transparently uses the rl_accel C extension for string widths and
+# PDF escaping when it is installed (pip install rl_accel).
+try:
+    import _rl_accel  # noqa: F401
+except ImportError:
+    print("WARNING: rl_accel is not installed. PDF export will use ReportLab's slower pure-Python fallbacks.", file=sys.stderr)
 
 # Path to your external PDF document
 DOCUMENT_PATH = "external_doc.pdf"
@@ -17,18 +43,199 @@ DOCUMENT_PATH = "external_doc.pdf"
 # This block is for handling the ImportError if rag_setup.py is not found
 # and for creating the RAG chain
 try:
-    from rag_setup import create_rag_chain
+    from rag_setup import (
+        create_rag_chain, chunk_id, index_key, load_documents, retrieve_context, stream_rag_answer, warm_up_models,
+        LLM_MODEL,
+    )
     rag_chain = create_rag_chain(DOCUMENT_PATH)
+    # Shared cache entries are only valid for this document, index and model
+    cache_namespace = f"{index_key(DOCUMENT_PATH)}:{LLM_MODEL}"
 except FileNotFoundError:
     print(f"ERROR: Document '{DOCUMENT_PATH}' not found. Please add it to the project directory.", file=sys.stderr)
     rag_chain = None
-except ImportError:
-    print("ERROR: rag_setup.py not found. Please ensure it's in the project directory.", file=sys.stderr)
+    cache_namespace = None
+except ImportError as e:
+    print(f"ERROR: Could not import the RAG pipeline: {e}. Ensure rag_setup.py is in the project directory and its dependencies are installed.", file=sys.stderr)
     rag_chain = None
+    cache_namespace = None
+
+def warm_up_rag_chain():
+    """Has Ollama load the model weights before the first real question arrives."""
+    try:
+        warm_up_models(rag_chain)
+    except Exception as e:
+        print(f"WARNING: RAG warm-up query failed: {e}", file=sys.stderr)
+
+if rag_chain is not None:
+    threading.Thread(target=warm_up_rag_chain, daemon=True).start()
+
+# ----------------- RAG Response Cache -----------------
+# Answers are cached in-process with an LRU, and optionally in Redis so that
+# multiple workers share the same cache. Set REDIS_URL to enable Redis.
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_TTL_SECONDS = 3600
+CACHE_MAX_ENTRIES = 512
+
+try:
+    import redis
+    redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+except ImportError:
+    if REDIS_URL:
+        print("WARNING: REDIS_URL is set but the redis package is not installed. Using the in-process cache only.", file=sys.stderr)
+    redis_client = None
+
+_answer_cache = OrderedDict()
+_answer_cache_lock = threading.Lock()
+
+# Punctuation to strip, except decimal points and ranges between digits
+# ("1.5", "10-20") and percent signs after digits, so figures stay distinct
+_PUNCTUATION_RE = re.compile(r"(?!(?<=\d)[.\-](?=\d)|(?<=\d)%)[^\w\s]")
+
+def normalize_question(question: str) -> str:
+    """Lowercases the question, strips punctuation and collapses whitespace."""
+    question = _PUNCTUATION_RE.sub("", question.lower())
+    return re.sub(r"\s+", " ", question).strip()
+
+def _cache_key(normalized_question: str, prefix: str = "rag") -> str:
+    key = f"{cache_namespace}\n{normalized_question}"
+    return f"{prefix}:" + hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def get_cached_answer(question: str):
+    """Returns the cached answer for a question, or None if it has not been answered yet."""
+    normalized_question = normalize_question(question)
+    with _answer_cache_lock:
+        if normalized_question in _answer_cache:
+            _answer_cache.move_to_end(normalized_question)
+            return _answer_cache[normalized_question]
+
+    if redis_client is not None:
+        try:
+            cached = redis_client.get(_cache_key(normalized_question))
+        except redis.RedisError as e:
+            print(f"WARNING: Redis cache lookup failed: {e}", file=sys.stderr)
+            return None
+        if cached is not None:
+            answer = cached.decode("utf-8")
+            _store_local(normalized_question, answer)
+            return answer
+    return None
+
+def set_cached_answer(question: str, answer: str) -> None:
+    """Stores an answer in the in-process cache and, if configured, in Redis."""
+    normalized_question = normalize_question(question)
+    _store_local(normalized_question, answer)
+    if redis_client is not None:
+        try:
+            redis_client.setex(_cache_key(normalized_question), CACHE_TTL_SECONDS, answer)
+        except redis.RedisError as e:
+            print(f"WARNING: Redis cache write failed: {e}", file=sys.stderr)
+
+def _store_local(normalized_question: str, answer: str) -> None:
+    with _answer_cache_lock:
+        _answer_cache[normalized_question] = answer
+        _answer_cache.move_to_end(normalized_question)
+        if len(_answer_cache) > CACHE_MAX_ENTRIES:
+            _answer_cache.popitem(last=False)
+
+# ----------------- Retrieval Prefetch -----------------
+# While the user is typing, the browser posts the draft question to /prefetch
+# and the reranked context is kept, so Submit can go straight to generation.
+# With REDIS_URL set, the chunk ids are shared through Redis so the /stream
+# request can use them even when it lands on another worker.
+MIN_QUESTION_LENGTH = 3
+PREFETCH_TTL_SECONDS = 300
+PREFETCH_MAX_ENTRIES = 128
+# A pending prefetch finishes sooner than a fresh retrieval would, so /stream
+# waits for it; the timeout only guards against a stuck request
+PREFETCH_WAIT_SECONDS = 10
+_prefetched_context = OrderedDict()
+_prefetch_in_flight = {}
+_prefetch_lock = threading.Lock()
+
+def get_prefetched_context(question: str):
+    """Returns documents retrieved ahead of time for a question, or None."""
+    normalized_question = normalize_question(question)
+    with _prefetch_lock:
+        if normalized_question in _prefetched_context:
+            return _prefetched_context[normalized_question]
+
+    if redis_client is not None:
+        try:
+            cached = redis_client.get(_cache_key(normalized_question, prefix="prefetch"))
+        except redis.RedisError as e:
+            print(f"WARNING: Redis prefetch lookup failed: {e}", file=sys.stderr)
+            return None
+        if cached is not None:
+            return load_documents(rag_chain, json.loads(cached))
+    return None
+
+def wait_for_prefetched_context(question: str):
+    """Returns prefetched documents for a question, first waiting for a prefetch still running in this worker."""
+    with _prefetch_lock:
+        pending = _prefetch_in_flight.get(normalize_question(question))
+    if pending is not None:
+        pending.wait(PREFETCH_WAIT_SECONDS)
+    return get_prefetched_context(question)
+
+def set_prefetched_context(question: str, docs) -> None:
+    """Stores documents retrieved ahead of time for a question."""
+    normalized_question = normalize_question(question)
+    with _prefetch_lock:
+        _prefetched_context[normalized_question] = docs
+        _prefetched_context.move_to_end(normalized_question)
+        if len(_prefetched_context) > PREFETCH_MAX_ENTRIES:
+            _prefetched_context.popitem(last=False)
+
+    if redis_client is not None:
+        ids = [chunk_id(doc.page_content) for doc in docs]
+        try:
+            redis_client.setex(_cache_key(normalized_question, prefix="prefetch"), PREFETCH_TTL_SECONDS, json.dumps(ids))
+        except redis.RedisError as e:
+            print(f"WARNING: Redis prefetch write failed: {e}", file=sys.stderr)
+
+# ----------------- Background Callback Manager -----------------
+# Slow callbacks (PDF export) run outside the Dash worker. Set
+# CELERY_BROKER_URL to use Celery (a worker must be running), otherwise a
+# local diskcache-backed process pool is used. Without either, the export
+# runs in the request worker. Dash reads callback results from the Celery
+# result backend, which must be a key-value store such as Redis; set
+# CELERY_RESULT_BACKEND when the broker is not (e.g. an amqp:// broker).
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
+background_callback_manager = None
+
+if CELERY_BROKER_URL:
+    try:
+        from celery import Celery
+        celery_app = Celery(__name__, broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+        background_callback_manager = CeleryManager(celery_app)
+    except ImportError:
+        print("WARNING: CELERY_BROKER_URL is set but celery is not installed. Falling back to the diskcache manager.", file=sys.stderr)
+
+if background_callback_manager is None:
+    try:
+        import diskcache
+        background_callback_manager = DiskcacheManager(diskcache.Cache(".dash-cache"))
+    except ImportError:
+        print("WARNING: diskcache is not installed. PDF export will run in the request worker.", file=sys.stderr)
 
 # ----------------- Dash App Initialization -----------------
 # Initialize the Dash app here, before it is used anywhere else.
-app = dash.Dash(__name__)
+# Dash's compress option gzips callback JSON and static assets through
+# flask-compress, so it is only enabled when that package is installed.
+try:
+    import flask_compress  # noqa: F401
+    compress = True
+except ImportError:
+    print("WARNING: flask-compress is not installed. Responses will be sent uncompressed.", file=sys.stderr)
+    compress = False
+
+app = dash.Dash(__name__, compress=compress, background_callback_manager=background_callback_manager)
+server = app.server
+
+# Streamed responses are left alone so /stream tokens are not buffered by the
+# compressor.
+server.config['COMPRESS_STREAMS'] = False
 
 # Sample data for a dashboard chart
 df = pd.DataFrame({
@@ -36,38 +243,34 @@ df = pd.DataFrame({
     "Q1 2025 Revenue ($M)": [1.5, 0.7, 1.1]
 })
 
-def create_pdf_report(graph_image_buffer, rag_response: str) -> io.BytesIO:
-    """Creates a PDF report using reportlab and the graph image, with proper text wrapping."""
+# Report styles and fixed flowables are built once; only the graph and the
+# response paragraph change between downloads.
+_REPORT_STYLES = getSampleStyleSheet()
+_REPORT_HEADER = [
+    Paragraph("<b>AI-Powered Data Report</b>", _REPORT_STYLES['h1']),
+    Spacer(1, 0.2*inch),
+    Paragraph("<b>Q1 2025 Regional Revenue</b>", _REPORT_STYLES['h2']),
+    Spacer(1, 0.2*inch),
+]
+_REPORT_ANALYSIS_HEADER = [
+    Spacer(1, 0.5*inch),
+    Paragraph("<b>LLM Analysis</b>", _REPORT_STYLES['h2']),
+    Spacer(1, 0.1*inch),
+]
+
+def create_pdf_report(graph_drawing, rag_response: str) -> io.BytesIO:
+    """Creates a PDF report using reportlab and the graph drawing, with proper text wrapping."""
     buffer = io.BytesIO()
     
     # Use SimpleDocTemplate for flowable content like Paragraphs
     doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=inch, leftMargin=inch)
-    
-    styles = getSampleStyleSheet()
-    story = []
 
-    # Title
-    story.append(Paragraph("<b>AI-Powered Data Report</b>", styles['h1']))
-    story.append(Spacer(1, 0.2*inch))
-    
-    # Graph Section
-    story.append(Paragraph("<b>Q1 2025 Regional Revenue</b>", styles['h2']))
-    story.append(Spacer(1, 0.2*inch))
-    
-    # Create a BytesIO object for the image data
-    image_bytes_io = io.BytesIO(graph_image_buffer)
-    
-    # Add graph image using platypus.Image with explicit width and height
-    img = PlatypusImage(image_bytes_io, width=6*inch, height=3.5*inch)
-    story.append(img)
-    story.append(Spacer(1, 0.5*inch))
-    
-    # RAG Response Section
-    story.append(Paragraph("<b>LLM Analysis</b>", styles['h2']))
-    story.append(Spacer(1, 0.1*inch))
+    # Title and graph section header, then the graph drawing, then the RAG
+    # response section header
+    story = _REPORT_HEADER + [graph_drawing] + _REPORT_ANALYSIS_HEADER
     
     # Add the RAG response text as a Paragraph for automatic wrapping
-    story.append(Paragraph(rag_response, styles['Normal']))
+    story.append(Paragraph(rag_response, _REPORT_STYLES['Normal']))
 
     # Build the document
     doc.build(story)
@@ -80,6 +283,67 @@ initial_figure = go.Figure(
     layout=go.Layout(xaxis={'title': 'Region'}, yaxis={'title': 'Revenue ($M)'})
 )
 
+# The graph is never updated by a callback, so the PDF export reads this
+# server-side copy instead of shipping the figure back as callback State.
+initial_figure_dict = json.loads(initial_figure.to_json())
+
+# Size of the chart in the PDF report
+GRAPH_WIDTH = 6*inch
+GRAPH_HEIGHT = 3.5*inch
+
+def _trace_values(values) -> list:
+    """Returns trace data as a list, decoding Plotly's base64 typed-array encoding if present."""
+    if isinstance(values, dict) and 'bdata' in values:
+        return np.frombuffer(base64.b64decode(values['bdata']), dtype=values['dtype']).tolist()
+    return list(values)
+
+def _axis_title(layout, axis: str) -> str:
+    title = layout.get(axis, {}).get('title', '')
+    return title.get('text', '') if isinstance(title, dict) else title
+
+def _bar_colors(trace) -> list:
+    """Returns the trace's marker colours as ReportLab colours; raises ValueError for unsupported values."""
+    marker_color = trace.get('marker', {}).get('color')
+    if marker_color is None:
+        return []
+    if isinstance(marker_color, str):
+        return [colors.toColor(marker_color)]
+    if isinstance(marker_color, list) and all(isinstance(color, str) for color in marker_color):
+        return [colors.toColor(color) for color in marker_color]
+    raise ValueError(f"Unsupported marker colour: {marker_color!r}")
+
+def create_bar_chart_drawing(figure_dict) -> Drawing:
+    """Draws a single-trace bar figure with ReportLab primitives, avoiding a Kaleido export."""
+    trace = figure_dict['data'][0]
+    layout = figure_dict.get('layout', {})
+    drawing = Drawing(GRAPH_WIDTH, GRAPH_HEIGHT)
+
+    # Plotly numbers the bars from 0 when no categories are given
+    y_values = _trace_values(trace['y'])
+    x_values = _trace_values(trace['x']) if 'x' in trace else range(len(y_values))
+
+    chart = VerticalBarChart()
+    chart.x, chart.y = 50, 40
+    chart.width, chart.height = GRAPH_WIDTH - 70, GRAPH_HEIGHT - 60
+    chart.data = [y_values]
+    chart.categoryAxis.categoryNames = [str(x) for x in x_values]
+    chart.valueAxis.valueMin = 0
+    chart.barSpacing = 10
+
+    bar_colors = _bar_colors(trace)
+    if len(bar_colors) == 1:
+        chart.bars[0].fillColor = bar_colors[0]
+    else:
+        for i, color in enumerate(bar_colors):
+            chart.bars[(0, i)].fillColor = color
+    drawing.add(chart)
+
+    # Axis titles
+    drawing.add(String(chart.x + chart.width / 2, 8, _axis_title(layout, 'xaxis'), textAnchor='middle', fontSize=10))
+    y_title = String(0, 0, _axis_title(layout, 'yaxis'), textAnchor='middle', fontSize=10)
+    drawing.add(Group(y_title, transform=(0, 1, -1, 0, 14, chart.y + chart.height / 2)))
+    return drawing
+
 def create_dashboard_layout(graph_figure, rag_response_text):
     """Generates the main layout of the dashboard."""
     return html.Div(
@@ -108,6 +372,7 @@ def create_dashboard_layout(graph_figure, rag_response_text):
                 ]
             ),
             dcc.Store(id='rag-response-store'),
+            dcc.Store(id='prefetch'),
             html.Button('Download Report as PDF', id='download-button', n_clicks=0, style={'marginTop': '20px', 'padding': '10px', 'fontSize': '16px'}),
             dcc.Download(id="download-pdf")
         ]
@@ -118,42 +383,165 @@ app.layout = create_dashboard_layout(initial_figure, "Enter a question and click
 
 # ----------------- Callbacks -----------------
 
-@app.callback(
+def _sse_event(data: str, event: str = None) -> str:
+    """Formats a Server-Sent Event; the payload is JSON-encoded so newlines survive."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.server.route('/stream')
+def stream_response():
+    """Streams the RAG answer for the `q` query parameter as Server-Sent Events."""
+    question = request.args.get('q', '')
+
+    def generate():
+        if rag_chain is None:
+            yield _sse_event("RAG system not initialized. Check server logs for errors.", event="rag-error")
+            return
+        cached = get_cached_answer(question)
+        if cached is not None:
+            yield _sse_event(cached)
+            yield _sse_event("", event="done")
+            return
+        tokens = []
+        try:
+            for token in stream_rag_answer(rag_chain, question, docs=wait_for_prefetched_context(question)):
+                tokens.append(token)
+                yield _sse_event(token)
+        except Exception as e:
+            yield _sse_event(f"An error occurred: {e}", event="rag-error")
+            return
+        set_cached_answer(question, "".join(tokens))
+        yield _sse_event("", event="done")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.server.route('/prefetch', methods=['POST'])
+def prefetch_context():
+    """Retrieves context for a draft question so a later /stream request can skip retrieval."""
+    question = (request.get_json(silent=True) or {}).get('q', '')
+    if rag_chain is None or len(question) < MIN_QUESTION_LENGTH:
+        return '', 204
+    normalized_question = normalize_question(question)
+    with _prefetch_lock:
+        if normalized_question in _prefetch_in_flight:
+            return '', 204
+        done = _prefetch_in_flight[normalized_question] = threading.Event()
+    try:
+        if get_cached_answer(question) is None and get_prefetched_context(question) is None:
+            set_prefetched_context(question, retrieve_context(rag_chain, question))
+    except Exception as e:
+        print(f"WARNING: Retrieval prefetch failed: {e}", file=sys.stderr)
+    finally:
+        with _prefetch_lock:
+            del _prefetch_in_flight[normalized_question]
+        done.set()
+    return '', 204
+
+# Opens an EventSource on /stream and renders tokens into the response box as
+# they arrive. The final text is written to the store used by the PDF export.
+app.clientside_callback(
+    """
+    function(n_clicks, question) {
+        const noUpdate = window.dash_clientside.no_update;
+        if (!question) {
+            return [noUpdate, ""];
+        }
+        if (window.ragEventSource) {
+            window.ragEventSource.close();
+        }
+        const setProps = window.dash_clientside.set_props;
+        const source = new EventSource('/stream?q=' + encodeURIComponent(question));
+        window.ragEventSource = source;
+        let text = "";
+        setProps('rag-response-store', {data: null});
+        const fail = function(message) {
+            source.close();
+            setProps('rag-response', {children: {
+                type: 'P', namespace: 'dash_html_components',
+                props: {children: message, style: {color: 'red'}}
+            }});
+            setProps('rag-response-store', {data: message});
+        };
+        source.onmessage = function(e) {
+            text += JSON.parse(e.data);
+            setProps('rag-response', {children: text});
+        };
+        source.addEventListener('done', function() {
+            source.close();
+            setProps('rag-response-store', {data: text});
+        });
+        source.addEventListener('rag-error', function(e) {
+            fail(JSON.parse(e.data));
+        });
+        source.onerror = function() {
+            fail("An error occurred: the response stream was interrupted.");
+        };
+        return ["", ""];
+    }
+    """,
     Output('rag-response', 'children'),
-    Output('rag-response-store', 'data'),
     Output('question-input', 'value'),
     Input('submit-button', 'n_clicks'),
     State('question-input', 'value'),
     prevent_initial_call=True
 )
-def update_response(n_clicks, question):
-    if rag_chain is None:
-        return html.P("RAG system not initialized. Check server logs for errors.", style={'color': 'red'}), "RAG system not initialized.", ""
-    if question:
-        try:
-            response = rag_chain.invoke({"query": question})
-            response_text = response['result']
-            return html.P(response_text), response_text, ""
-        except Exception as e:
-            error_message = f"An error occurred: {e}"
-            return html.P(error_message, style={'color': 'red'}), error_message, ""
-    return dash.no_update, dash.no_update, ""
+
+# Prefetch retrieval once the user pauses typing for 300 ms.
+app.clientside_callback(
+    """
+    function(question) {
+        clearTimeout(window.ragPrefetchTimer);
+        if (question && question.length >= %d) {
+            window.ragPrefetchTimer = setTimeout(function() {
+                fetch('/prefetch', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({q: question})
+                }).catch(function() {
+                    // Prefetch is best-effort; Submit retrieves on its own
+                });
+            }, 300);
+        }
+        return window.dash_clientside.no_update;
+    }
+    """ % MIN_QUESTION_LENGTH,
+    Output('prefetch', 'data'),
+    Input('question-input', 'value'),
+    prevent_initial_call=True
+)
+
+# Keep Submit disabled until the question is long enough, in the browser
+# without a server round-trip.
+app.clientside_callback(
+    "function(question) { return !question || question.length < %d; }" % MIN_QUESTION_LENGTH,
+    Output('submit-button', 'disabled'),
+    Input('question-input', 'value')
+)
 
 @app.callback(
     Output("download-pdf", "data"),
     Input("download-button", "n_clicks"),
-    State('main-graph', 'figure'),
     State('rag-response-store', 'data'),
+    background=background_callback_manager is not None,
+    running=[(Output("download-button", "disabled"), True, False)],
     prevent_initial_call=True
 )
-def download_pdf(n_clicks, graph_figure, rag_response_text):
+def download_pdf(n_clicks, rag_response_text):
     if n_clicks is None or not rag_response_text:
         return dash.no_update
 
-    img_bytes = pio.to_image(graph_figure, format="png")
-    pdf_buffer = create_pdf_report(img_bytes, rag_response_text)
+    pdf_buffer = create_pdf_report(create_bar_chart_drawing(initial_figure_dict), rag_response_text)
     return dcc.send_bytes(pdf_buffer.getvalue(), "analysis_report.pdf")
 
 # ----------------- App Run -----------------
+# Development server only. In production run the Flask server with several
+# workers, e.g. `gunicorn -w 4 -k gthread --threads 8 app:server`.
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    # Each open /stream response holds a server thread while Ollama generates;
+    # Flask's development server is threaded by default, so others still run.
+    debug = os.getenv("DASH_DEBUG", "").lower() in ("1", "true", "yes")
+    app.run(debug=debug, host='0.0.0.0')
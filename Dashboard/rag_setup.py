@@ -1,41 +1,276 @@
 import os
+import sys
+import hashlib
+import shutil
+import tempfile
+import faiss
 from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_ollama import OllamaEmbeddings
 from langchain_community.llms import Ollama
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains import RetrievalQA
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain.retrievers.document_compressors import CrossEncoderReranker
+from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+from langchain.prompts import PromptTemplate
+from langchain_core.documents import Document
+
+# Directory holding one persisted FAISS index per document and index settings
+INDEX_DIR = ".faiss_index"
+
+# Bump whenever the way the index is built changes, so stale indexes on disk
+# are rebuilt instead of reused
+INDEX_BUILD_VERSION = 2
+
+# Text splitter settings
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# HNSW graph parameters: neighbours per node and build/search beam widths
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Number of chunks sent to Ollama's /api/embed endpoint per request
+EMBED_BATCH_SIZE = 32
+
+# Retrieval over-fetches candidates and a local cross-encoder keeps the best few
+RETRIEVAL_CANDIDATES = 20
+RERANK_TOP_N = 3
+RERANKER_MODEL = "BAAI/bge-reranker-base"
+
+# Minimum cosine similarity for a chunk to be considered at all
+RELEVANCE_SCORE_THRESHOLD = 0.35
+
+# Pinned 4-bit quantized Llama 3.1 build and generation limits. Three 1000
+# character chunks plus the prompt fit comfortably in a 2048 token context.
+LLM_MODEL = "llama3.1:8b-instruct-q4_K_M"
+LLM_NUM_CTX = 2048
+LLM_NUM_PREDICT = 256
+LLM_NUM_THREAD = os.cpu_count()
+
+# Keep the model resident between questions (in seconds). Ollama reuses the KV
+# cache of the longest matching prompt prefix, which is lost if it is unloaded.
+LLM_KEEP_ALIVE = 1800
+
+# Query embeddings come from the same model and must send the same runner
+# options as generation; otherwise Ollama reloads the runner between the
+# embedding and generation steps of every question.
+EMBEDDING_MODEL = LLM_MODEL
+
+# Compact prompt used for every query; a short template keeps prefill cheap.
+# The instruction prefix must stay byte-identical across queries and the
+# variable parts stay at the end so Ollama can reuse the prefix's KV cache.
+RAG_PROMPT = PromptTemplate(
+    input_variables=["context", "question"],
+    template="Answer concisely using only the context.\nContext:\n{context}\nQ: {question}\nA:",
+)
+
+def file_sha256(path: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def index_key(document_path: str) -> str:
+    """
+    Returns the directory name for a document's index.
+
+    The key covers the PDF contents and every setting that changes the stored
+    vectors, so a different embedding model or splitter never reuses an index.
+    """
+    settings = f"{file_sha256(document_path)}:{EMBEDDING_MODEL}:{CHUNK_SIZE}:{CHUNK_OVERLAP}:{INDEX_BUILD_VERSION}"
+    return hashlib.sha256(settings.encode()).hexdigest()
+
+def chunk_id(content: str) -> str:
+    """
+    Returns the docstore id of a chunk, derived from its text.
+    """
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+def cosine_relevance_score(distance: float) -> float:
+    """
+    Converts a squared L2 distance between unit vectors into cosine similarity.
+
+    Used by the similarity_score_threshold retriever in create_rag_chain.
+    """
+    return 1.0 - distance / 2.0
+
+def build_hnsw_vectorstore(texts, embeddings) -> FAISS:
+    """
+    Embeds the chunks in batches and stores them in a FAISS HNSW index.
+
+    Chunks with identical text (overlap windows, repeated headers and footers)
+    are embedded only once; their content hash doubles as the docstore id.
+    Vectors are L2-normalized, so cosine_relevance_score turns FAISS's squared
+    L2 distances into true cosine similarities for the retriever's
+    RELEVANCE_SCORE_THRESHOLD.
+    """
+    ids, contents, metadatas = [], [], []
+    seen = set()
+    for text in texts:
+        digest = chunk_id(text.page_content)
+        if digest in seen:
+            continue
+        seen.add(digest)
+        ids.append(digest)
+        contents.append(text.page_content)
+        metadatas.append(text.metadata)
+
+    vectors = []
+    for start in range(0, len(contents), EMBED_BATCH_SIZE):
+        vectors.extend(embeddings.embed_documents(contents[start:start + EMBED_BATCH_SIZE]))
+
+    index = faiss.IndexHNSWFlat(len(vectors[0]), HNSW_M)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        normalize_L2=True,
+        relevance_score_fn=cosine_relevance_score,
+    )
+    vectorstore.add_embeddings(zip(contents, vectors), metadatas=metadatas, ids=ids)
+    return vectorstore
 
 def create_rag_chain(document_path: str):
     """
     Creates a RetrievalQA chain using Llama 3.1 from a PDF document.
+
+    The FAISS index is persisted under a directory named by index_key(), so
+    restarts reuse the existing embeddings unless the PDF or index settings change.
     """
-    # 1. Load the PDF document
-    loader = PyPDFLoader(document_path)
-    documents = loader.load()
+    embeddings = OllamaEmbeddings(
+        model=EMBEDDING_MODEL,
+        num_ctx=LLM_NUM_CTX,
+        num_thread=LLM_NUM_THREAD,
+        keep_alive=LLM_KEEP_ALIVE,
+    )
+    persist_directory = os.path.join(INDEX_DIR, index_key(document_path))
 
-    # 2. Split the documents into chunks
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    texts = text_splitter.split_documents(documents)
+    if os.path.isdir(persist_directory):
+        # 1. Reuse the persisted index for this exact document. The docstore
+        # is a pickle written by this function, so deserializing it is safe.
+        vectorstore = FAISS.load_local(
+            persist_directory,
+            embeddings,
+            allow_dangerous_deserialization=True,
+            normalize_L2=True,
+            relevance_score_fn=cosine_relevance_score,
+        )
+        vectorstore.index.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        # 2. Load the PDF document
+        loader = PyPDFLoader(document_path)
+        documents = loader.load()
+
+        # 3. Split the documents into chunks
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        texts = text_splitter.split_documents(documents)
 
-    # 3. Create vector store from chunks and persist it
-    embeddings = OllamaEmbeddings(model="llama3.1")
-    vectorstore = Chroma.from_documents(documents=texts, embedding=embeddings)
+        # 4. Create the HNSW index from chunks and persist it. The index is
+        # written to a temporary directory and renamed into place, so several
+        # workers starting at once never load a half-written index.
+        vectorstore = build_hnsw_vectorstore(texts, embeddings)
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        temp_directory = tempfile.mkdtemp(dir=INDEX_DIR)
+        vectorstore.save_local(temp_directory)
+        try:
+            os.replace(temp_directory, persist_directory)
+        except OSError:
+            # Another worker finished first; keep its index and drop ours
+            shutil.rmtree(temp_directory, ignore_errors=True)
 
-    # 4. Create a retriever from the vector store
-    retriever = vectorstore.as_retriever()
+    # 5. Create a retriever that fetches up to 20 chunks with cosine similarity
+    # of at least 0.35 and reranks them with a cross-encoder, keeping the best 3
+    base_retriever = vectorstore.as_retriever(
+        search_type="similarity_score_threshold",
+        search_kwargs={"k": RETRIEVAL_CANDIDATES, "score_threshold": RELEVANCE_SCORE_THRESHOLD},
+    )
+    try:
+        reranker = CrossEncoderReranker(model=HuggingFaceCrossEncoder(model_name=RERANKER_MODEL), top_n=RERANK_TOP_N)
+        retriever = ContextualCompressionRetriever(base_compressor=reranker, base_retriever=base_retriever)
+    except OSError as e:
+        # The reranker is downloaded from the Hugging Face hub on first use;
+        # when that fails (e.g. offline), fall back to the plain top 3 chunks
+        print(f"WARNING: Could not load reranker '{RERANKER_MODEL}': {e}. Using the top {RERANK_TOP_N} retrieved chunks.", file=sys.stderr)
+        retriever = vectorstore.as_retriever(
+            search_type="similarity_score_threshold",
+            search_kwargs={"k": RERANK_TOP_N, "score_threshold": RELEVANCE_SCORE_THRESHOLD},
+        )
 
-    # 5. Connect to the Llama 3.1 model via Ollama
-    llm = Ollama(model="llama3.1")
+    # 6. Connect to the Llama 3.1 model via Ollama
+    llm = Ollama(
+        model=LLM_MODEL,
+        num_ctx=LLM_NUM_CTX,
+        num_predict=LLM_NUM_PREDICT,
+        num_thread=LLM_NUM_THREAD,
+        keep_alive=LLM_KEEP_ALIVE,
+    )
 
-    # 6. Create a RetrievalQA chain
+    # 7. Create a RetrievalQA chain
     qa_chain = RetrievalQA.from_chain_type(
         llm=llm,
         chain_type="stuff",
         retriever=retriever,
+        chain_type_kwargs={"prompt": RAG_PROMPT},
     )
     return qa_chain
 
+def _vectorstore(qa_chain) -> FAISS:
+    """
+    Returns the chain's vector store, with or without the reranking wrapper.
+    """
+    retriever = getattr(qa_chain.retriever, "base_retriever", qa_chain.retriever)
+    return retriever.vectorstore
+
+def warm_up_models(qa_chain) -> None:
+    """
+    Makes Ollama load the model with one query embedding and a one-token generation.
+    """
+    _vectorstore(qa_chain).embeddings.embed_query("warmup")
+    qa_chain.combine_documents_chain.llm_chain.llm.invoke("warmup", num_predict=1)
+
+def retrieve_context(qa_chain, question: str):
+    """
+    Returns the reranked documents the chain would stuff into the prompt.
+    """
+    return qa_chain.retriever.invoke(question)
+
+def load_documents(qa_chain, ids):
+    """
+    Looks up retrieved chunks by id, returning None if any is no longer in the index.
+    """
+    docstore = _vectorstore(qa_chain).docstore
+    docs = [docstore.search(doc_id) for doc_id in ids]
+    if not all(isinstance(doc, Document) for doc in docs):
+        return None
+    return docs
+
+def stream_rag_answer(qa_chain, question: str, docs=None):
+    """
+    Yields the answer to a question token by token.
+
+    Retrieval and prompt building mirror the chain's "stuff" step, but the LLM
+    is called with stream() so callers receive tokens as soon as they are decoded.
+    Documents retrieved ahead of time can be passed in to skip retrieval.
+    """
+    if docs is None:
+        docs = retrieve_context(qa_chain, question)
+    llm_chain = qa_chain.combine_documents_chain.llm_chain
+    context = "\n\n".join(doc.page_content for doc in docs)
+    prompt = llm_chain.prompt.format(context=context, question=question)
+    yield from llm_chain.llm.stream(prompt)
+
 if __name__ == '__main__':
     # This is a test run to ensure the RAG system works
     if not os.path.exists("external_doc.pdf"):